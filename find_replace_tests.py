@@ -1,18 +1,69 @@
 #!/usr/bin/env python
 
-from __future__ import print_function
-
 import unittest
 import subprocess as subproc
 import os
+import sys
+import io
+import contextlib
 import shutil
-import imp
+import tempfile
+import importlib.machinery
+import importlib.util
 
 curdir = os.path.abspath(os.path.dirname(__file__))
-# cannot import find_replace directly because it doesn't have the .py extension
-find_replace = imp.load_source('find_replace',
-                               os.path.join(curdir, 'find_replace'))
-from find_replace import PermissionError
+# cannot import find_replace directly because it doesn't have the .py
+# extension, so the loader has to be given explicitly. The loaded module is
+# cached in sys.modules to be reused when this file is imported again.
+if 'find_replace' in sys.modules:
+    find_replace = sys.modules['find_replace']
+else:
+    _fr_path = os.path.join(curdir, 'find_replace')
+    _spec = importlib.util.spec_from_file_location(
+        'find_replace', _fr_path,
+        loader=importlib.machinery.SourceFileLoader('find_replace', _fr_path))
+    find_replace = importlib.util.module_from_spec(_spec)
+    sys.modules['find_replace'] = find_replace
+    _spec.loader.exec_module(find_replace)
+
+# contents of the test files, encoded once to be written with os.write()
+PAYLOAD_A = b'test test\ntest\n'
+PAYLOAD_B = b'test find test\nfind test\n'
+# contents of a PAYLOAD_B file after 'find ' was replaced with 'found '
+EXPECTED = b'test found test\nfound test\n'
+
+
+def _write_one(entry):
+    """ creates one test file from a (path, payload, mode) tuple """
+    path, payload, mode = entry
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.write(fd, payload)
+    os.close(fd)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def _read_bytes(path):
+    """ returns the content of a file, or None if it cannot be read """
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_all(plan):
+    """ creates all files of the plan """
+    for entry in plan:
+        _write_one(entry)
+
+
+def _get_tmp_base():
+    """ returns /dev/shm if it is writable, the default tmp dir otherwise """
+    # keep the test files in memory when tmpfs is available
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
 
 
 class FindReplaceTest(unittest.TestCase):
@@ -21,29 +72,44 @@ class FindReplaceTest(unittest.TestCase):
 
     Methods
     --------
+    setUpClass :
+        creates a template directory with the test files once for all tests.
+    tearDownClass :
+        removes the private temporary directory with the template.
     setUp :
-        creates a directory and files to test find_replace
+        creates a directory and files to test find_replace by hardlinking
+        the template
     tearDown :
         removes the test directory recursively
+    _make_plan :
+        returns the (path, payload, mode) tuples of the test files inside a
+        directory.
+    _fast_rmtree :
+        removes the contents of a directory using os.scandir().
     reset :
         removes the directory, then creates again. Required to test
         find_replace several times within one test.
+    _restore :
+        writes the starting content back into the files changed by
+        find_replace and recreates the removed ones. A cheaper alternative to
+        reset.
     add_hundred_files :
         adds hundred empty files into the test directory to test if the
         percentage is shown correctly in such case.
     replace_case :
-        runs the find_replace.find_replace() function with different arguments
-        and checks returned values for mistakes.
+        runs the find_replace.find_replace() function with different arguments,
+        checks returned values for mistakes, and returns the bytes paths of the
+        changed files.
     test_replace :
         runs find_replace.find_replace() with and without regex mode and tests
         returned values.
     get_output :
         runs find_replace script with different arguments and returns output.
     check_percent_output :
-        runs find_replace script and checks if the output equals the expected
+        runs find_replace.main() and checks if the output equals the expected
         one.
     test_percentage :
-        runs find_replace script with below and above 100 files and checks if
+        runs find_replace.main() with below and above 100 files and checks if
         "Progress: 100%" is in output.
     test_warning :
         runs find_replace script with no filename patterns and checks if the
@@ -60,32 +126,100 @@ class FindReplaceTest(unittest.TestCase):
     -----------
     str curdir :
         The directory where the script is executed.
+    str _tmp_base :
+        The directory the private temporary directory is created in. /dev/shm
+        if it is writable, the default temporary directory otherwise.
+    str _tmp_dir :
+        The private temporary directory holding the template and the test
+        directory. Created by setUpClass with tempfile.mkdtemp().
+    str _template :
+        The path to the template directory the test directory is copied from.
     str path :
         The path to a test directory.
-    list files_list :
-        The list of paths to the test files.
+    bytes _path_b, _sub_b :
+        The paths to the test directory and its subdirectory encoded to bytes.
+    list _plan :
+        The list of (path, payload, mode) tuples describing the test files.
+    str user_path :
+        The home directory of the user test_stats_saving operates under.
+        /home/cp_user unless FR_TEST_USER_HOME is set.
+    int user_uid, user_gid :
+        The owner of user_path, None if it doesn't exist.
+    OSError user_error :
+        The error raised by os.stat(user_path), None if it succeeded.
 
     Notes
     ------
     Put the script in the same folder as "find_replace" to run tests.
     """
+    _tmp_base = _get_tmp_base()
+    _files = ['1.php', '2.php', '3.php', 'test_data2/4.php', '1.html',
+              '2.html', '3.html', 'test_data2/4.html', '1.txt', '2.txt',
+              '3.txt', 'test_data2/4.txt']
+
     def __init__(self, *args, **kwargs):
         # unittest.TestCase has its own __init__()
-        # Format of super() is compatible with Python2 and Python3
-        super(FindReplaceTest, self).__init__(*args, **kwargs)
+        super().__init__(*args, **kwargs)
         self.curdir = os.path.abspath(os.path.dirname(__file__))
-        self.path = os.path.join(self.curdir, 'test_data')
-        files_list = ['1.php', '2.php', '3.php', 'test_data2/4.php', '1.html',
-                      '2.html', '3.html', 'test_data2/4.html', '1.txt',
-                      '2.txt', '3.txt', 'test_data2/4.txt']
-        self.files_list = [
-            os.path.join(self.path, file) for file in files_list]
+
+    @classmethod
+    def _make_plan(cls, root):
+        """
+        Returns (path, payload, mode) for each test file inside root; path is
+        encoded to bytes, mode is None when the default permissions should be
+        kept.
+        """
+        plan = []
+        for file in cls._files:
+            name = os.path.basename(file)
+            payload = PAYLOAD_A if name.startswith('1') else PAYLOAD_B
+            mode = 0o111 if name.startswith('2.') else None
+            plan.append((os.fsencode(os.path.join(root, file)), payload, mode))
+        return plan
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Creates the template directory the tests copy from and saves the owner
+        of the user directory used by test_stats_saving.
+        """
+        # Both the template and the test directory live in a directory only
+        # this user can write to, so nobody can plant a symlink in place of
+        # the test directory. Keeping them together also keeps them on the
+        # same filesystem, otherwise the template couldn't be hardlinked.
+        cls._tmp_dir = tempfile.mkdtemp(
+            prefix='find_replace_test_', dir=cls._tmp_base)
+        cls._template = os.path.join(cls._tmp_dir, 'template')
+        cls.path = os.path.join(cls._tmp_dir, 'test_data')
+        # bytes paths skip the filesystem encoding on every os call
+        cls._path_b = os.fsencode(cls.path)
+        cls._sub_b = os.fsencode(cls.path + '/test_data2')
+        cls._plan = cls._make_plan(cls.path)
+        os.mkdir(cls._template)
+        os.mkdir(cls._template + '/test_data2')
+        _write_all(cls._make_plan(cls._template))
+        # insert any existing user here or pass it in FR_TEST_USER_HOME
+        cls.user_path = os.environ.get('FR_TEST_USER_HOME', '/home/cp_user')
+        # a missing directory must fail test_stats_saving, not the whole class
+        cls.user_error = None
+        try:
+            user_stat = os.stat(cls.user_path)
+            cls.user_uid, cls.user_gid = user_stat.st_uid, user_stat.st_gid
+        except OSError as error:  # no such user directory
+            cls.user_uid = cls.user_gid = None
+            cls.user_error = error
+
+    @classmethod
+    def tearDownClass(cls):
+        """ removes the private temporary directory with the template """
+        cls._fast_rmtree(cls._tmp_dir)
+        os.rmdir(cls._tmp_dir)
 
     def setUp(self):
         """
-        Creates the following data tree:
-        /
-        |_/test_data
+        Hardlinks the template into the following data tree:
+        /dev/shm (or the default temporary directory)
+        |_/find_replace_test_<random>/test_data
           |__1.html --- doesn't contain searched pattern
           |__1.php  --- doesn't contain searched pattern
           |__1.txt  --- doesn't contain searched pattern
@@ -100,57 +234,87 @@ class FindReplaceTest(unittest.TestCase):
             |__4.php
             |__4.txt
         """
+        # Hardlinks are safe to share with the template: find_replace
+        # replaces the files it changes with new ones instead of writing into
+        # them, and the permissions of the copies are never changed.
         try:
-            os.mkdir(self.path)
-        except OSError:
+            shutil.copytree(self._template, self.path, copy_function=os.link)
+        except FileExistsError:
             self.tearDown()
-            os.mkdir(self.path)
-        os.mkdir(self.path + '/test_data2')
-        for file in self.files_list:
-            with open(os.path.join('test_data', file), 'w') as f:
-                if '1' in file:
-                    f.write('test test\ntest\n')
-                else:
-                    f.write('test find test\nfind test\n')
-            if '2.' in file:
-                os.chmod(file, 0o111)
+            shutil.copytree(self._template, self.path, copy_function=os.link)
 
     def tearDown(self):
         """ removes the test directory recursively """
-        shutil.rmtree(self.path)
+        self._fast_rmtree(self.path)
+        os.rmdir(self.path)
+
+    @staticmethod
+    def _fast_rmtree(root):
+        """ removes everything inside root, leaving root itself in place """
+        # os.scandir() follows a symlinked root, shutil.rmtree() refuses it
+        if os.path.islink(root):
+            raise OSError('Cannot remove the contents of a symbolic link: '
+                          '{0}'.format(root))
+        for entry in os.scandir(root):
+            if entry.is_dir(follow_symlinks=False):
+                FindReplaceTest._fast_rmtree(entry.path)
+                os.rmdir(entry.path)
+            else:
+                os.unlink(entry.path)
 
     def reset(self):
         """ recreates starting setup """
         self.tearDown()
         self.setUp()
 
+    def _restore(self, changed_files):
+        """
+        Writes the starting content back into the files changed by
+        find_replace and recreates the missing ones. Cheaper than reset() when
+        only a few files were changed.
+        """
+        for file in changed_files:
+            fd = os.open(file, os.O_WRONLY | os.O_TRUNC)
+            os.write(fd, PAYLOAD_B)
+            os.close(fd)
+        # find_replace removes the files it has no permission to read, because
+        # FileInput renames them to a backup before failing to open them.
+        for entry in self._plan:
+            if not os.path.exists(entry[0]):
+                _write_one(entry)
+
     def add_hundred_files(self):
         """ adds hundred files from 5.php to 104.php """
-        for number in range(5, 105):
-            file = os.path.join(self.path, str(number)+'.php')
-            with open(file, 'w') as f:
-                f.write('test')
+        names = [self._path_b + b'/' + str(number).encode() + b'.php'
+                 for number in range(5, 105)]
+        _write_all([(file, b'test', None) for file in names])
 
     def replace_case(self, path, find, regex, file_patterns,
                      expected_occurences, expected_skipped, expected_filtered,
                      expected_changed_files):
-        """ tests if find_replace.find_replace() returns correct values """
+        """
+        Tests if find_replace.find_replace() returns correct values. Returns
+        the list of bytes paths of the test files that were changed.
+        """
         replace = 'found '
         occurences, skipped, filtered = find_replace.find_replace(
             path, find, replace, regex, file_patterns, testing=True)
         self.assertEqual(occurences, expected_occurences)
         self.assertEqual(skipped, expected_skipped)
         self.assertEqual(filtered, expected_filtered)
-        changed_files = 0
-        # go trough all files and count changed ones.
-        for file in self.files_list:
-            try:
-                with open(file) as f:
-                    if f.read() == 'test found test\nfound test\n':
-                        changed_files += 1
-            except IOError:
-                continue
-        self.assertEqual(changed_files, expected_changed_files)
+        # go trough all files and collect changed ones. Files of any other
+        # size cannot hold the expected content, so only those of the right
+        # size are read.
+        candidates = []
+        for root in (self._path_b, self._sub_b):
+            for entry in os.scandir(root):
+                if (entry.is_file() and
+                        entry.stat().st_size == len(EXPECTED)):
+                    candidates.append(entry.path)
+        changed_files = [file for file in candidates
+                         if _read_bytes(file) == EXPECTED]
+        self.assertEqual(len(changed_files), expected_changed_files)
+        return changed_files
 
     def test_replace(self):
         """ tests find_replace.find_replace with regex On and Off """
@@ -158,21 +322,22 @@ class FindReplaceTest(unittest.TestCase):
         # verifies number of occurences
         # verifies number of skipped
         # verifies number of changed files
-        self.replace_case(
+        changed_files = self.replace_case(
             self.path, 'find ', False, ['*.php', '*.html'], 8, 2, 8, 4)
-        self.reset()
+        self._restore(changed_files)
         self.replace_case(
             self.path, r'f[i,o]n?d\s', True, ['*.php', '*.html'], 8, 2, 8, 4)
 
     def get_output(self, file_patterns):
         """
         Gets output of the script and tranforms from byte string to a regular
-        string.
+        string. file_patterns is a list of filename patterns passed to the
+        script as separate arguments.
         """
-        # {0} is for really old versions of Python
+        script = os.path.join(self.curdir, 'find_replace')
         output = subproc.check_output(
-            "cd {0} && ./find_replace {1} find found {2}".format(
-                self.curdir, self.path, file_patterns), shell=True)
+            [script, self.path, 'find', 'found'] + file_patterns,
+            cwd=self.curdir)
         return output.decode()
 
     def check_percent_output(self, total_files):
@@ -180,18 +345,19 @@ class FindReplaceTest(unittest.TestCase):
         Verifies that the output contains "Progress: 100%" and is in general
         correct.
         """
-        output = self.get_output("'*.php' '*.html'")
-        # find Progress: 100%
-        pos = output.find('Progress: 100%')
-        if pos != -1:
-            # cut off all other percent numbers
-            output = output[pos:]
-        else:
-            self.fail('No "Progress: 100%" found in output')
+        # find_replace.main() is called in-process to avoid starting a new
+        # interpreter, test_warning covers running the script itself.
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
+            find_replace.main([self.path, 'find', 'found', '*.php', '*.html'])
+        output = buf.getvalue()
+        # find the last Progress: 100% and cut off all other percent numbers
+        _, sep, tail = output.rpartition('Progress: 100%')
+        self.assertTrue(sep, 'No "Progress: 100%" found in output')
         expected_output = 'Progress: 100%\n\nOccurences replaced: 8\nFiles' + \
                           ' skipped (Permission denied): 2\nTotal files ' + \
                           'searched: {0}\n'.format(total_files)
-        self.assertEqual(output, expected_output)
+        self.assertEqual(sep + tail, expected_output)
 
     def test_percentage(self):
         """ tests the script with below and above 100 files """
@@ -207,7 +373,7 @@ class FindReplaceTest(unittest.TestCase):
         Tests that the warning is shown when no file patterns are passed to the
         script.
         """
-        output = self.get_output('')
+        output = self.get_output([])
         self.assertIn(
             '** Consider using file patterns to speed up the process **',
             output)
@@ -218,44 +384,40 @@ class FindReplaceTest(unittest.TestCase):
         correct with 0, 1, and multiple filename patterns.
         """
         file_patterns = []
-        self.replace_case(
+        changed_files = self.replace_case(
             self.path, 'find ', False, file_patterns, 12, 3, 12, 6)
-        self.reset()
+        self._restore(changed_files)
         file_patterns = ['*.php']
-        self.replace_case(self.path, 'find ', False, file_patterns, 4, 1, 4, 2)
-        self.reset()
+        changed_files = self.replace_case(
+            self.path, 'find ', False, file_patterns, 4, 1, 4, 2)
+        self._restore(changed_files)
         file_patterns = ['*.php', '*.html']
         self.replace_case(self.path, 'find ', False, file_patterns, 8, 2, 8, 4)
 
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                         'This test case can be run by root or sudoer only')
     def test_stats_saving(self):
         """
         Checks that find_replace.find_replace() saves permissions and owner of
         a file when the script is run under another user.
         !!! Run this test under root or a sudo user !!!
         """
-        try:
-            os.mkdir('/etc/foo')
-            shutil.rmtree('/etc/foo')
-        except (PermissionError, OSError):  # PermissionError is for Python3,
-            # OSError is for Python2
-            self.fail('This test case can be run by root or sudoer only')
-
-        user_path = '/home/cp_user'  # insert any existing user here
-        user_stat = os.stat(user_path)
-        user_uid, user_gid = user_stat[4], user_stat[5]
+        if self.user_error is not None:
+            self.fail('Cannot stat the user directory: {0}'.format(
+                self.user_error))
         filename = 'test_stats_saving.txt'  # must be unique because
         # find_replace looks for this filename recursively
-        filepath = os.path.join(user_path, filename)
+        filepath = os.path.join(self.user_path, filename)
         with open(filepath, 'w') as f:
             f.write('find ')
-        os.chown(filepath, user_uid, user_gid)
+        os.chown(filepath, self.user_uid, self.user_gid)
         # changed files = 0 because self.replace_case() is looking for changed
-        # files only in the test_data directory
-        self.replace_case(user_path, 'find ', False, ['test_stats_saving.txt'],
-                          1, 0, 1, 0)
+        # files only in the test directory
+        self.replace_case(self.user_path, 'find ', False,
+                          ['test_stats_saving.txt'], 1, 0, 1, 0)
         file_stat = os.stat(filepath)
-        file_uid, file_gid = file_stat[4], file_stat[5]
-        self.assertEqual((user_uid, user_gid), (file_uid, file_gid))
+        self.assertEqual((self.user_uid, self.user_gid),
+                         (file_stat.st_uid, file_stat.st_gid))
         os.remove(filepath)
 
 